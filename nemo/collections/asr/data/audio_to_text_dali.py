@@ -12,18 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import math
+import os
 from collections.abc import Iterator
-from typing import Callable, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Union
 
 import torch
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
 from nemo.collections.common.parts.preprocessing import parsers
 from nemo.utils.decorators import experimental
 
 try:
     import nvidia.dali as dali
+    import nvidia.dali.math
     from nvidia.dali.pipeline import Pipeline
     from nvidia.dali.plugin.pytorch import DALIGenericIterator as DALIPytorchIterator
     from nvidia.dali.plugin.pytorch import LastBatchPolicy as LastBatchPolicy
@@ -36,6 +37,22 @@ __all__ = [
     'AudioToCharDALIDataset',
 ]
 
+# Window functions supported by the DALI spectrogram. None selects DALI's default (Hann).
+_WINDOW_FNS = {
+    None: None,
+    'hann': None,
+    'ones': lambda n: torch.ones(n),
+    'hamming': lambda n: torch.hamming_window(n, periodic=False),
+    'blackman': lambda n: torch.blackman_window(n, periodic=False),
+    'bartlett': lambda n: torch.bartlett_window(n, periodic=False),
+}
+
+# Named values accepted for log_zero_guard_value
+_LOG_ZERO_GUARD_VALUES = {
+    'tiny': torch.finfo(torch.float32).tiny,
+    'eps': torch.finfo(torch.float32).eps,
+}
+
 
 class DALIOutputs(object):
     def __init__(self, out_dict):
@@ -69,6 +86,62 @@ class DALIOutputs(object):
         return len(self._outs)
 
 
+# Upper bound on the default number of DALI CPU threads per pipeline
+_MAX_DEFAULT_NUM_THREADS = 16
+
+
+def _default_num_threads(device: str, world_size: int) -> int:
+    """Splits the CPU cores available to this process between the ranks running on the same node.
+
+    The ranks per node are taken from `LOCAL_WORLD_SIZE` if set, then from the number of visible GPUs
+    when running on the GPU. Otherwise all `world_size` ranks are assumed to share the node.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        num_cores = len(os.sched_getaffinity(0))  # Respects cgroup/affinity limits
+    else:
+        num_cores = os.cpu_count() or 1
+
+    if 'LOCAL_WORLD_SIZE' in os.environ:
+        ranks_per_node = int(os.environ['LOCAL_WORLD_SIZE'])
+    elif device == 'gpu' and torch.cuda.is_available() and torch.cuda.device_count() > 0:
+        ranks_per_node = min(torch.cuda.device_count(), world_size)
+    else:
+        ranks_per_node = world_size
+
+    return min(_MAX_DEFAULT_NUM_THREADS, max(1, num_cores // max(1, ranks_per_node)))
+
+
+def _normalize_prefetch_queue_depth(
+    prefetch_queue_depth: Union[int, Dict[str, int], DictConfig]
+) -> Union[int, Dict[str, int]]:
+    """Converts `prefetch_queue_depth` to the plain int or dict that DALI accepts.
+
+    Values coming from the model config are DictConfigs, and DALI checks the exact type of the argument.
+    """
+    if isinstance(prefetch_queue_depth, DictConfig):
+        prefetch_queue_depth = OmegaConf.to_container(prefetch_queue_depth, resolve=True)
+
+    is_int = isinstance(prefetch_queue_depth, int) and not isinstance(prefetch_queue_depth, bool)
+    is_dict = isinstance(prefetch_queue_depth, dict) and set(prefetch_queue_depth) == {'cpu_size', 'gpu_size'}
+    if not (is_int or is_dict):
+        raise ValueError(
+            f"Received {prefetch_queue_depth} for the prefetch_queue_depth parameter."
+            f" It must be either an int or a dict with 'cpu_size' and 'gpu_size' keys."
+        )
+    return prefetch_queue_depth
+
+
+# TODO come up with a better solution
+class _DaliAsrDummyDataset:
+    """Exposes the size of a DALI dataset through `len()`, as NeMo expects from `dataset` objects"""
+
+    def __init__(self, parent):
+        self.parent = parent
+
+    def __len__(self):
+        return self.parent.size
+
+
 @experimental
 class AudioToCharDALIDataset(Iterator):
     """
@@ -85,6 +158,9 @@ class AudioToCharDALIDataset(Iterator):
         sample_rate (int): Sample rate to resample loaded audio to.
         batch_size (int): Number of samples in a batch.
         num_threads (int): Number of CPU processing threads to be created by the DALI pipeline.
+                           Defaults to the CPU cores available to the process divided by the number of ranks on the
+                           node, capped at 16. The ranks on the node are given by `LOCAL_WORLD_SIZE` if set, else by
+                           the number of visible GPUs when device == 'gpu', else by `world_size`.
         max_duration (float): Determines the maximum allowed duration, in seconds, of the loaded audio files.
         min_duration (float): Determines the minimum allowed duration, in seconds, of the loaded audio files.
         blank_index (int): blank character index, default = -1
@@ -101,6 +177,16 @@ class AudioToCharDALIDataset(Iterator):
         global_rank (int): Worker rank, used for partitioning shards. Defaults to 0.
         world_size (int): Total number of processes, used for partitioning shards. Defaults to 1.
         preprocessor_cfg (DictConfig): Preprocessor configuration. Supports AudioToMelSpectrogramPreprocessor and AudioToMFCCPreprocessor.
+        preprocessor_device (str): Device type to be used for the feature extraction operators.
+                                   Allowed values are: 'cpu', 'gpu'. Defaults to `device`.
+                                   Setting it to 'cpu' while `device` == 'gpu' leaves the GPU to the model and
+                                   copies the extracted features to the GPU at the end of the pipeline.
+        prefetch_queue_depth (int or dict): Depth of the DALI prefetch queue. Can also be given as a dict
+                                            {"cpu_size": int, "gpu_size": int} to size the CPU and GPU stages
+                                            separately. Defaults to 2.
+        stream_priority (int): CUDA priority of the DALI pipeline stream. Lower numbers mean higher priority
+                               and 0 is the lowest priority, so the default of 0 lets model kernels on higher
+                               priority streams take precedence. Only applicable when device == 'gpu'.
     """
 
     def __init__(
@@ -110,7 +196,7 @@ class AudioToCharDALIDataset(Iterator):
         batch_size: int,
         labels: Union[str, List[str]],
         sample_rate: int = 16000,
-        num_threads: int = 4,
+        num_threads: Optional[int] = None,
         max_duration: float = 0.0,
         min_duration: float = 0.0,
         blank_index: int = -1,
@@ -126,6 +212,9 @@ class AudioToCharDALIDataset(Iterator):
         global_rank: int = 0,
         world_size: int = 1,
         preprocessor_cfg: DictConfig = None,
+        preprocessor_device: Optional[str] = None,
+        prefetch_queue_depth: Union[int, Dict[str, int]] = 2,
+        stream_priority: int = 0,
     ):
         self.drop_last = drop_last  # used by lr_scheduler
         if not HAVE_DALI:
@@ -139,9 +228,25 @@ class AudioToCharDALIDataset(Iterator):
                 f"{self} received an unexpected device argument {device}. Supported values are: 'cpu', 'gpu'"
             )
 
+        if preprocessor_device is None:
+            preprocessor_device = device
+        if preprocessor_device not in ('cpu', 'gpu'):
+            raise ValueError(
+                f"{self} received an unexpected preprocessor_device argument {preprocessor_device}. "
+                f"Supported values are: 'cpu', 'gpu'"
+            )
+        if preprocessor_device == 'gpu' and device != 'gpu':
+            raise ValueError(f"{self} received preprocessor_device='gpu', which requires device='gpu'")
+
+        prefetch_queue_depth = _normalize_prefetch_queue_depth(prefetch_queue_depth)
+
+        if num_threads is None:
+            num_threads = _default_num_threads(device, world_size)
+
         self.batch_size = batch_size  # Used by NeMo
 
         self.device = device
+        self.preprocessor_device = preprocessor_device
         self.device_id = device_id
 
         if world_size > 1:
@@ -169,6 +274,8 @@ class AudioToCharDALIDataset(Iterator):
             device_id=self.device_id,
             exec_async=True,
             exec_pipelined=True,
+            prefetch_queue_depth=prefetch_queue_depth,
+            default_cuda_stream_priority=stream_priority,
         )
 
         has_preprocessor = preprocessor_cfg is not None
@@ -191,7 +298,7 @@ class AudioToCharDALIDataset(Iterator):
             self.window_stride_sec = params['window_stride'] if 'window_stride' in params else 0.01
             self.sample_rate = params['sample_rate'] if 'sample_rate' in params else sample_rate
             self.window_size = int(self.window_size_sec * self.sample_rate)
-            self.window_stride = int(self.window_size_sec * self.sample_rate)
+            self.window_stride = int(self.window_stride_sec * self.sample_rate)
 
             normalize = params['normalize'] if 'normalize' in params else 'per_feature'
             if normalize == 'per_feature':  # Each freq channel independently
@@ -204,27 +311,17 @@ class AudioToCharDALIDataset(Iterator):
                     f" It must be either 'per_feature' or 'all_features'."
                 )
 
-            self.window = None
             window_name = params['window'] if 'window' in params else None
-            torch_windows = {
-                'hamming': torch.hamming_window,
-                'blackman': torch.blackman_window,
-                'bartlett': torch.bartlett_window,
-            }
-            if window_name is None or window_name == 'hann':
-                self.window = None  # Hann is DALI's default
-            elif window_name == 'ones':
-                self.window = torch.ones(self.window_size)
-            else:
-                try:
-                    window_fn = torch_windows.get(window_name, None)
-                    self.window = window_fn(self.window_size, periodic=False)
-                except:
-                    raise ValueError(
-                        f"{self} received {window_name} for the window parameter."
-                        f" It must be one of: ('hann', 'ones', 'hamming', 'blackman', 'bartlett', None)."
-                        f" None is equivalent to 'hann'."
-                    )
+            try:
+                window_fn = _WINDOW_FNS[window_name]
+            except KeyError:
+                raise ValueError(
+                    f"{self} received {window_name} for the window parameter."
+                    f" It must be one of: ('hann', 'ones', 'hamming', 'blackman', 'bartlett', None)."
+                    f" None is equivalent to 'hann'."
+                )
+            # DALI takes the window samples as a list of floats of size window_length
+            self.window = None if window_fn is None else window_fn(self.window_size).tolist()
 
             self.n_fft = params['n_fft'] if 'n_fft' in params else None  # None means default
             self.n_mels = params['n_mels'] if 'n_mels' in params else 64
@@ -237,6 +334,13 @@ class AudioToCharDALIDataset(Iterator):
                 elif feature_type == 'mfcc':
                     self.n_mfcc = features
 
+            # The MFCCs are the DCT of the mel spectrogram, so there can't be more of them than mel filters
+            if feature_type == 'mfcc' and self.n_mfcc > self.n_mels:
+                raise ValueError(
+                    f"{self} received n_mfcc={self.n_mfcc} and n_mels={self.n_mels}."
+                    f" n_mfcc must not be greater than n_mels."
+                )
+
             # TODO Implement frame splicing
             if 'frame_splicing' in params:
                 assert params['frame_splicing'] == 1, "Frame splicing is not implemented"
@@ -258,15 +362,12 @@ class AudioToCharDALIDataset(Iterator):
 
             self.log_zero_guard_value = params['log_zero_guard_value'] if 'log_zero_guard_value' in params else 1e-05
             if isinstance(self.log_zero_guard_value, str):
-                if self.log_zero_guard_value == "tiny":
-                    self.log_zero_guard_value = torch.finfo(torch.float32).tiny
-                elif self.log_zero_guard_value == "eps":
-                    self.log_zero_guard_value = torch.finfo(torch.float32).eps
-                else:
+                if self.log_zero_guard_value not in _LOG_ZERO_GUARD_VALUES:
                     raise ValueError(
-                        f"{self} received {self.log_zero_guard_value} for the log_zero_guard_type parameter."
-                        f"It must be either a number, 'tiny', or 'eps'"
+                        f"{self} received {self.log_zero_guard_value} for the log_zero_guard_value parameter."
+                        f" It must be either a number, 'tiny', or 'eps'"
                     )
+                self.log_zero_guard_value = _LOG_ZERO_GUARD_VALUES[self.log_zero_guard_value]
 
             self.mag_power = params['mag_power'] if 'mag_power' in params else 2
             if self.mag_power != 1.0 and self.mag_power != 2.0:
@@ -294,30 +395,39 @@ class AudioToCharDALIDataset(Iterator):
                 pad_last_batch=False,
             )
 
-            transcript_len = dali.fn.shapes(dali.fn.reshape(transcript, shape=[-1]))
+            # The raw transcript is a 1-D byte sequence, so its shape is already the length.
+            # The length is only consumed on the host to decode the bytes, so INT32 is enough.
+            transcript_len = dali.fn.shapes(transcript, dtype=dali.types.INT32)
             transcript = dali.fn.pad(transcript)
 
+            # Audio stays on the CPU when the preprocessing is done there
+            audio_device = self.preprocessor_device if has_preprocessor else self.device
+
             # Extract nonsilent region, if necessary
             if trim:
                 # Need to extract non-silent region before moving to the GPU
                 roi_start, roi_len = dali.fn.nonsilent_region(audio, cutoff_db=-60)
-                audio = audio.gpu() if self.device == 'gpu' else audio
+                audio = audio.gpu() if audio_device == 'gpu' else audio
                 audio = dali.fn.slice(
                     audio, roi_start, roi_len, normalized_anchor=False, normalized_shape=False, axes=[0]
                 )
             else:
-                audio = audio.gpu() if self.device == 'gpu' else audio
+                audio = audio.gpu() if audio_device == 'gpu' else audio
 
             if not has_preprocessor:
                 # No preprocessing, the output is the audio signal
-                audio_len = dali.fn.shapes(dali.fn.reshape(audio, shape=[-1]))
+                # Audio is downmixed to a 1-D signal, so its shape is already the length
+                audio_len = dali.fn.shapes(audio)
                 audio = dali.fn.pad(audio)
                 self.pipe.set_outputs(audio, audio_len, transcript, transcript_len)
             else:
                 # Additive gaussian noise (dither)
+                # The noise takes the shape of the audio (one sample per element) and is generated already scaled
                 if self.dither > 0.0:
-                    gaussian_noise = dali.fn.normal_distribution(device=self.device)
-                    audio = audio + self.dither * gaussian_noise
+                    gaussian_noise = dali.fn.normal_distribution(
+                        audio, stddev=self.dither, device=self.preprocessor_device
+                    )
+                    audio = audio + gaussian_noise
 
                 # Preemphasis filter
                 if self.preemph > 0.0:
@@ -325,7 +435,12 @@ class AudioToCharDALIDataset(Iterator):
 
                 # Power spectrogram
                 spec = dali.fn.spectrogram(
-                    audio, nfft=self.n_fft, window_length=self.window_size, window_step=self.window_stride
+                    audio,
+                    nfft=self.n_fft,
+                    window_length=self.window_size,
+                    window_step=self.window_stride,
+                    window_fn=self.window,
+                    power=int(self.mag_power),
                 )
 
                 if feature_type == 'mel_spectrogram' or feature_type == 'mfcc':
@@ -343,21 +458,34 @@ class AudioToCharDALIDataset(Iterator):
                         spec = dali.fn.mfcc(spec, n_mfcc=self.n_mfcc)
 
                 # Logarithm
+                # Written as a single arithmetic expression, which DALI evaluates in one fused elementwise pass.
+                # The clamp is kept for 'add' too: after the MFCC's DCT the input can be negative.
                 if self.log_zero_guard_type == 'add':
-                    spec = spec + self.log_zero_guard_value
-
-                spec = dali.fn.to_decibels(
-                    spec, multiplier=math.log(10), reference=1.0, cutoff_db=math.log(self.log_zero_guard_value)
-                )
+                    spec = dali.math.log(dali.math.max(spec + self.log_zero_guard_value, self.log_zero_guard_value))
+                else:
+                    spec = dali.math.log(dali.math.max(spec, self.log_zero_guard_value))
 
                 # Normalization
                 spec = dali.fn.normalize(spec, axes=self.normalization_axes)
 
-                # Extracting the length of the spectrogram
-                spec_len = dali.fn.slice(dali.fn.shapes(spec), 1, 1, axes=(0,))
+                # Extracting the length of the spectrogram (temporal axis of the 'ft' layout)
+                spec_len = dali.fn.shapes(spec)[1:2]
 
                 # Pads feature dimension to be a multiple of `pad_to` and the temporal dimension to be as big as the largest sample (shape -1)
-                spec = dali.fn.pad(spec, fill_value=self.pad_value, axes=(0, 1), align=(self.pad_to, 1), shape=(1, -1))
+                # The temporal padding is always needed to batch the samples,
+                # the feature alignment only when pad_to > 1
+                if self.pad_to > 1:
+                    spec = dali.fn.pad(
+                        spec, fill_value=self.pad_value, axes=(0, 1), align=(self.pad_to, 1), shape=(1, -1)
+                    )
+                else:
+                    spec = dali.fn.pad(spec, fill_value=self.pad_value, axes=(1,))
+
+                # Features extracted on the CPU are handed to the model on the GPU, along with their lengths,
+                # so that the outputs are placed as in the all-GPU pipeline
+                if self.device == 'gpu' and self.preprocessor_device == 'cpu':
+                    spec = spec.gpu()
+                    spec_len = spec_len.gpu()
                 self.pipe.set_outputs(spec, spec_len, transcript, transcript_len)
         # Building DALI pipeline
         self.pipe.build()
@@ -377,15 +505,7 @@ class AudioToCharDALIDataset(Iterator):
             auto_reset=True,
         )
 
-        # TODO come up with a better solution
-        class DummyDataset:
-            def __init__(self, parent):
-                self.parent = parent
-
-            def __len__(self):
-                return self.parent.size
-
-        self.dataset = DummyDataset(self)  # Used by NeMo
+        self.dataset = _DaliAsrDummyDataset(self)  # Used by NeMo
 
     def reset(self):
         self._iter.reset()
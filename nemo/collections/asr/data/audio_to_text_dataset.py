@@ -231,6 +231,7 @@ def get_dali_char_dataset(
         batch_size=config['batch_size'],
         labels=config['labels'],
         sample_rate=config['sample_rate'],
+        num_threads=config.get('num_threads', None),
         max_duration=config.get('max_duration', None),
         min_duration=config.get('min_duration', None),
         blank_index=config.get('blank_index', -1),
@@ -243,5 +244,8 @@ def get_dali_char_dataset(
         global_rank=global_rank,
         world_size=world_size,
         preprocessor_cfg=preprocessor_cfg,
+        preprocessor_device=config.get('preprocessor_device', None),
+        prefetch_queue_depth=config.get('prefetch_queue_depth', 2),
+        stream_priority=config.get('stream_priority', 0),
     )
     return dataset
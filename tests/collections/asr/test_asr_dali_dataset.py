@@ -0,0 +1,137 @@
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('nvidia.dali')
+
+import soundfile as sf
+import torch
+from omegaconf import OmegaConf
+
+from nemo.collections.asr.data.audio_to_text_dali import AudioToCharDALIDataset
+from nemo.collections.asr.modules import AudioToMelSpectrogramPreprocessor
+
+LABELS = list(" abcdefghijklmnopqrstuvwxyz'")
+SAMPLE_RATE = 16000
+DURATIONS = [1.0, 1.37]
+
+MEL_TARGET = 'nemo.collections.asr.modules.AudioToMelSpectrogramPreprocessor'
+MFCC_TARGET = 'nemo.collections.asr.modules.AudioToMFCCPreprocessor'
+
+
+@pytest.fixture()
+def manifest(tmp_path):
+    rng = np.random.RandomState(0)
+    signals = []
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        for i, duration in enumerate(DURATIONS):
+            signal = rng.uniform(-0.5, 0.5, size=int(duration * SAMPLE_RATE)).astype(np.float32)
+            audio_filepath = os.path.join(tmp_path, f'audio_{i}.wav')
+            sf.write(audio_filepath, signal, SAMPLE_RATE)
+            signals.append(signal)
+            f.write(json.dumps({'audio_filepath': audio_filepath, 'text': 'a b c', 'duration': duration}) + '\n')
+    return os.path.join(tmp_path, 'manifest.json'), signals
+
+
+def make_dataset(manifest_filepath, cfg, **kwargs):
+    device = 'gpu' if torch.cuda.is_available() else 'cpu'
+    return AudioToCharDALIDataset(
+        manifest_filepath=manifest_filepath,
+        device=device,
+        device_id=0 if device == 'gpu' else None,
+        batch_size=len(DURATIONS),
+        labels=LABELS,
+        sample_rate=SAMPLE_RATE,
+        shuffle=False,
+        preprocessor_cfg=OmegaConf.create(cfg),
+        **kwargs,
+    )
+
+
+def preprocessor_cfg(target=MEL_TARGET, **kwargs):
+    cfg = {'_target_': target, 'sample_rate': SAMPLE_RATE, 'dither': 0.0, 'n_fft': 512}
+    cfg.update(kwargs)
+    return cfg
+
+
+class TestAudioToCharDALIDataset:
+    @pytest.mark.unit
+    def test_frame_count_matches_preprocessor(self, manifest):
+        manifest_filepath, signals = manifest
+        dataset = make_dataset(manifest_filepath, preprocessor_cfg(window_size=0.02, window_stride=0.01))
+        dali_lens = next(dataset)[1].cpu().tolist()
+
+        preprocessor = AudioToMelSpectrogramPreprocessor(
+            sample_rate=SAMPLE_RATE, window_size=0.02, window_stride=0.01, n_fft=512, dither=0.0
+        )
+        max_len = max(len(signal) for signal in signals)
+        input_signal = torch.zeros(len(signals), max_len)
+        for i, signal in enumerate(signals):
+            input_signal[i, : len(signal)] = torch.from_numpy(signal)
+        length = torch.tensor([len(signal) for signal in signals])
+        _, torch_lens = preprocessor(input_signal=input_signal, length=length)
+
+        assert dali_lens == torch_lens.tolist()
+
+    @pytest.mark.unit
+    def test_mfcc_features_are_finite(self, manifest):
+        manifest_filepath, _ = manifest
+        dataset = make_dataset(manifest_filepath, preprocessor_cfg(MFCC_TARGET, log_zero_guard_type='add'))
+        features = next(dataset)[0]
+        assert torch.isfinite(features).all()
+
+    @pytest.mark.unit
+    def test_window_is_applied(self, manifest):
+        manifest_filepath, _ = manifest
+        hann = next(make_dataset(manifest_filepath, preprocessor_cfg(window='hann')))[0]
+        hamming = next(make_dataset(manifest_filepath, preprocessor_cfg(window='hamming')))[0]
+        assert hann.shape == hamming.shape
+        assert not torch.allclose(hann, hamming)
+
+    @pytest.mark.unit
+    def test_invalid_window(self, manifest):
+        manifest_filepath, _ = manifest
+        with pytest.raises(ValueError):
+            make_dataset(manifest_filepath, preprocessor_cfg(window='triangle'))
+
+    @pytest.mark.unit
+    def test_n_mfcc_greater_than_n_mels(self, manifest):
+        manifest_filepath, _ = manifest
+        with pytest.raises(ValueError):
+            make_dataset(manifest_filepath, preprocessor_cfg(MFCC_TARGET, n_mels=40, n_mfcc=64))
+
+    @pytest.mark.unit
+    def test_invalid_preprocessor_device(self, manifest):
+        manifest_filepath, _ = manifest
+        with pytest.raises(ValueError):
+            make_dataset(manifest_filepath, preprocessor_cfg(), preprocessor_device='tpu')
+
+    @pytest.mark.unit
+    def test_gpu_preprocessor_device_requires_gpu(self, manifest):
+        manifest_filepath, _ = manifest
+        with pytest.raises(ValueError):
+            AudioToCharDALIDataset(
+                manifest_filepath=manifest_filepath,
+                device='cpu',
+                device_id=None,
+                batch_size=len(DURATIONS),
+                labels=LABELS,
+                preprocessor_cfg=OmegaConf.create(preprocessor_cfg()),
+                preprocessor_device='gpu',
+            )
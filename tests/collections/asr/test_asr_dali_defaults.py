@@ -0,0 +1,90 @@
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from nemo.collections.asr.data import audio_to_text_dali
+
+
+@pytest.fixture()
+def host(monkeypatch):
+    """Fakes the cores and GPUs visible to the process, without LOCAL_WORLD_SIZE"""
+    monkeypatch.delenv('LOCAL_WORLD_SIZE', raising=False)
+
+    def configure(num_cores, num_gpus=0):
+        monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(num_cores)), raising=False)
+        monkeypatch.setattr(torch.cuda, 'is_available', lambda: num_gpus > 0)
+        monkeypatch.setattr(torch.cuda, 'device_count', lambda: num_gpus)
+
+    return configure
+
+
+class TestDefaultNumThreads:
+    @pytest.mark.unit
+    def test_single_node_gpu(self, host):
+        host(num_cores=64, num_gpus=8)
+        assert audio_to_text_dali._default_num_threads('gpu', world_size=8) == 8
+
+    @pytest.mark.unit
+    def test_multi_node_gpu(self, host):
+        host(num_cores=64, num_gpus=8)
+        assert audio_to_text_dali._default_num_threads('gpu', world_size=64) == 8
+
+    @pytest.mark.unit
+    def test_local_world_size(self, host, monkeypatch):
+        host(num_cores=64, num_gpus=8)
+        monkeypatch.setenv('LOCAL_WORLD_SIZE', '4')
+        assert audio_to_text_dali._default_num_threads('gpu', world_size=16) == 16
+
+    @pytest.mark.unit
+    def test_cpu_ranks_share_the_node(self, host):
+        host(num_cores=32)
+        assert audio_to_text_dali._default_num_threads('cpu', world_size=4) == 8
+
+    @pytest.mark.unit
+    def test_capped(self, host):
+        host(num_cores=64, num_gpus=1)
+        assert audio_to_text_dali._default_num_threads('gpu', world_size=1) == 16
+        assert audio_to_text_dali._default_num_threads('cpu', world_size=1) == 16
+
+    @pytest.mark.unit
+    def test_at_least_one_thread(self, host):
+        host(num_cores=2)
+        assert audio_to_text_dali._default_num_threads('cpu', world_size=8) == 1
+
+
+class TestNormalizePrefetchQueueDepth:
+    @pytest.mark.unit
+    def test_int(self):
+        assert audio_to_text_dali._normalize_prefetch_queue_depth(3) == 3
+
+    @pytest.mark.unit
+    def test_dict_config_is_converted(self):
+        cfg = OmegaConf.create({'depth': 4, 'prefetch_queue_depth': {'cpu_size': '${depth}', 'gpu_size': 2}})
+        prefetch_queue_depth = audio_to_text_dali._normalize_prefetch_queue_depth(cfg.prefetch_queue_depth)
+        assert type(prefetch_queue_depth) is dict
+        assert prefetch_queue_depth == {'cpu_size': 4, 'gpu_size': 2}
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize(
+        'prefetch_queue_depth',
+        [{'cpu_size': 2}, {'cpu_size': 2, 'gpu_size': 2, 'size': 2}, OmegaConf.create({'gpu_size': 2}), True, 2.0],
+    )
+    def test_invalid(self, prefetch_queue_depth):
+        with pytest.raises(ValueError):
+            audio_to_text_dali._normalize_prefetch_queue_depth(prefetch_queue_depth)